@@ -1,9 +1,10 @@
 import io
 import mmap
-from collections import defaultdict
+import struct
+from collections import OrderedDict, defaultdict
 from pathlib import Path
-from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
-from zipfile import ZipFile
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
 import skimage.io
 from torchvision.datasets import ImageFolder
@@ -13,6 +14,14 @@ __all__ = ["ZippedImageFolder"]
 
 default_loader = skimage.io.imread
 
+# local file header of a ZIP member, see section 4.3.7 of the ZIP specification
+#   https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_LOCAL_HEADER_SIZE = 30
+
+# read buffer for compressed members
+_READ_BUFFER_SIZE = 1 << 20
+
 
 class wrapped_mmap(mmap.mmap):
     """
@@ -32,6 +41,24 @@ class wrapped_mmap(mmap.mmap):
 
 
 class ZippedImageFolder(ImageFolder):
+    """
+    An `ImageFolder` that reads its images from a ZIP file.
+
+    Args:
+        root (Path): Path to the ZIP file.
+        directory (Path, optional): Root directory of the dataset inside the ZIP file.
+        transform (Callable, optional): A function that takes in a decoded sample and
+            returns a transformed version.
+        target_transform (Callable, optional): A function that takes in the target and
+            transforms it.
+        loader (Callable[[BinaryIO], Any], optional): A function to decode a sample from
+            a file-like object.
+        is_valid_file (Callable[[str], bool], optional): A function that takes path
+            of a file and checks if it is a valid file.
+        cache_size (int, optional): Number of decoded samples to keep in memory, 0 to
+            disable the cache. Each worker process holds its own cache.
+    """
+
     def __init__(
         self,
         root: Path,
@@ -40,11 +67,22 @@ class ZippedImageFolder(ImageFolder):
         target_transform: Optional[Callable] = None,
         loader: Callable[[BinaryIO], Any] = default_loader,
         is_valid_file: Optional[Callable[[str], bool]] = None,
+        cache_size: int = 0,
     ):
-        # using memmory mapped file handle to ensure this works with multiprocess
-        fd = open(root, mode="rb")
-        fd_mapped = wrapped_mmap(fd.fileno(), length=0, access=mmap.ACCESS_READ)
+        # using memmory mapped file handle to ensure this works with multiprocess, reads
+        # are served from the page cache and forked workers share the same pages
+        # NOTE mmap duplicates the file descriptor, the file object can be closed
+        with open(root, mode="rb") as fd:
+            fd_mapped = wrapped_mmap(fd.fileno(), length=0, access=mmap.ACCESS_READ)
         self._handle = ZipFile(fd_mapped, "r")
+        self._mmap = fd_mapped
+
+        # member name -> offset of its data in the ZIP file, only for stored members
+        self._data_offsets = {}
+
+        # decoded samples, before any (random) transformation is applied
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
 
         # NOTE necessary evil to leak the ZIP handle as private member, currently don't
         # have better way to expose this in __getitem__
@@ -167,8 +205,7 @@ class ZippedImageFolder(ImageFolder):
         """
         file, target = self.samples[index]
 
-        stream = self._handle.open(file, "r")
-        sample = self.loader(stream)
+        sample = self._load(file)
 
         if self.transform is not None:
             sample = self.transform(sample)
@@ -176,3 +213,72 @@ class ZippedImageFolder(ImageFolder):
             target = self.target_transform(target)
 
         return sample, target
+
+    def close(self):
+        """Release the ZIP file handle and its memory map."""
+        self._cache.clear()
+        self._handle.close()
+        self._mmap.close()
+
+    def _load(self, file: Union[str, ZipInfo]) -> Any:
+        """
+        Decode a member of the ZIP file using `loader`.
+
+        Decoded samples are kept in a LRU cache of `cache_size` entries.
+
+        Args:
+            file (str or ZipInfo): Name of the member, or its ZipInfo.
+        """
+        key = file.filename if isinstance(file, ZipInfo) else file
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        with self._open(file) as stream:
+            sample = self.loader(stream)
+
+        if self._cache_size > 0:
+            self._cache[key] = sample
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return sample
+
+    def _open(self, file: Union[str, ZipInfo]) -> BinaryIO:
+        """
+        Open a member of the ZIP file for reading.
+
+        Uncompressed members are sliced directly out of the memory mapped file, this
+        bypasses `ZipFile.open` which parses the local file header on every call.
+
+        Args:
+            file (str or ZipInfo): Name of the member, or its ZipInfo.
+        """
+        info = file if isinstance(file, ZipInfo) else self._handle.getinfo(file)
+        if info.compress_type != ZIP_STORED or info.flag_bits & 0x1:
+            # compressed or encrypted, let zipfile handle it, decoders tend to issue
+            # small reads, buffer them so zlib can inflate in larger chunks
+            stream = self._handle.open(info, "r")
+            return io.BufferedReader(stream, buffer_size=_READ_BUFFER_SIZE)
+
+        try:
+            offset = self._data_offsets[info.filename]
+        except KeyError:
+            offset = self._find_data_offset(info)
+            self._data_offsets[info.filename] = offset
+
+        return io.BytesIO(self._mmap[offset : offset + info.file_size])
+
+    def _find_data_offset(self, info: ZipInfo) -> int:
+        """Locate where data of a member starts, right after its local file header."""
+        offset = info.header_offset
+        header = self._mmap[offset : offset + _LOCAL_HEADER_SIZE]
+        if header[:4] != _LOCAL_HEADER_SIGNATURE:
+            raise ValueError(f"bad local file header for '{info.filename}'")
+
+        # local header has its own copy of file name and extra field, their lengths can
+        # differ from the central directory
+        filename_length, extra_length = struct.unpack("<HH", header[26:30])
+        return offset + _LOCAL_HEADER_SIZE + filename_length + extra_length
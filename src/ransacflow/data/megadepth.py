@@ -1,6 +1,8 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import io
 import logging
+import os
 import pickle
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -13,6 +15,7 @@ import torch
 from torch._C import Value
 from torchvision.transforms import Compose
 
+from ..util import save_atomic
 from . import transform
 from .dataset import ZippedImageFolder
 
@@ -20,15 +23,86 @@ __all__ = ["MegaDepthDataModule"]
 
 logger = logging.getLogger("ransacflow.data.megadepth")
 
+# layout of the cached validation instances, bump this whenever output of
+# `MegaDepthValidationDataset._make_dataset` changes
+_CACHE_VERSION = 1
+
+# every ordered pair of 2 distinct images out of 3
+_OFFSET_PAIRS = np.array(
+    [[0, 1], [0, 2], [1, 0], [1, 2], [2, 0], [2, 1]], dtype=np.int64
+)
+
+
+def _parse_coordinates(xs: pd.Series, ys: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert columns of semicolon-separated coordinates, e.g. '1.0;2.5;3.0', to ndarray.
+
+    Args:
+        xs (pd.Series): X coordinates of each row.
+        ys (pd.Series): Y coordinates of each row.
+
+    Returns:
+        (Tuple[np.ndarray, np.ndarray]): Coordinates in shape (N, K, 2), and number of
+            valid coordinates in each row. Shorter rows are padded with NaN.
+    """
+    # columns with a single coordinate per row are parsed as numbers by pandas
+    xs, ys = xs.astype(str), ys.astype(str)
+
+    lengths = xs.str.count(";").to_numpy() + 1
+    mismatched = np.flatnonzero(lengths != ys.str.count(";").to_numpy() + 1)
+    if mismatched.size:
+        raise ValueError(f"rows {mismatched.tolist()} have unpaired X/Y coordinates")
+
+    # split and convert the whole column in a single pass instead of row-by-row
+    xs_table = xs.str.split(";", expand=True).astype(np.float32).to_numpy()
+    ys_table = ys.str.split(";", expand=True).astype(np.float32).to_numpy()
+    features = np.stack([xs_table, ys_table], axis=-1)
+
+    return features, lengths
+
+
+def _seed_worker(worker_id: int):
+    """Reseed the random generator of the dataset copy owned by a DataLoader worker."""
+    worker_info = torch.utils.data.get_worker_info()
+    # otherwise, every worker inherits the same generator state from the main process
+    worker_info.dataset._rng = np.random.default_rng(worker_info.seed)
+
 
 class MegaDepthTrainingDataset(ZippedImageFolder):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # NOTE DataLoader workers need to reseed this, see `_seed_worker`
         self._rng = np.random.default_rng()
 
+        # pack member names into a fixed-width (N, 3) array, it holds no Python object,
+        # so forked workers share its pages without touching any refcount
+        # NOTE each sample is a row of 3 names, classes are still in `targets`
+        names = [files for files, _ in self.samples]
+        self.samples = self.imgs = np.array(names, dtype=np.str_)
+
+        # decode both images of a pair concurrently, the decoder releases the GIL
+        self._pool = None
+        self._pool_pid = None
+
         if self.target_transform is not None:
             logger.warning("target_transform is not used")
 
+    def _get_pool(self) -> ThreadPoolExecutor:
+        # threads do not survive fork, each worker process has to create its own pool
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=2)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            # a pool inherited through fork has no threads to join in this process
+            if self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+            self._pool_pid = None
+        super().close()
+
     @staticmethod
     def make_dataset(
         zip_path: Tuple[ZipFile, Path],
@@ -43,7 +117,8 @@ class MegaDepthTrainingDataset(ZippedImageFolder):
         # rebuild dictionary, and do sanity check
         instances = defaultdict(list)
         for file, target_class in items:
-            instances[target_class].append(file)
+            # member names only, they are much lighter than ZipInfo
+            instances[target_class].append(file.filename)
         for target_class, files in instances.items():
             assert len(files) == 3, f"'{target_class}' does not have 3 images"
 
@@ -51,19 +126,13 @@ class MegaDepthTrainingDataset(ZippedImageFolder):
 
     def __getitem__(self, index: int):
         # we need 2 images, randomly choose from [i+0]-[i+2] (3 images)
-        files, _ = self.samples[index]
-        offsets = self._rng.choice(3, size=2, replace=False)
+        files = self.samples[index]
+        offsets = _OFFSET_PAIRS[self._rng.integers(len(_OFFSET_PAIRS))]
 
         # we cannot use parent __getitem__ since transformations will be off
-        image_pair = []
-        for offset in offsets:
-            file = files[offset]
-
-            stream = self._handle.open(file, "r")
-            image = self.loader(stream)
-
-            image_pair.append(image)
-        image_pair = tuple(image_pair)
+        pool = self._get_pool()
+        futures = [pool.submit(self._load, str(files[offset])) for offset in offsets]
+        image_pair = tuple(future.result() for future in futures)
 
         assert (
             image_pair[0].shape == image_pair[1].shape
@@ -80,8 +149,15 @@ class MegaDepthTrainingDataset(ZippedImageFolder):
 
 class MegaDepthValidationDataset(ZippedImageFolder):
     def __init__(self, root: Path, directory: Optional[Path] = "/", *args, **kwargs):
-        # pass images directory to super
+        root = Path(root)
         directory = Path(directory)
+
+        # parsing the match list is slow, cache the instances next to the ZIP file, and
+        # invalidate them if the ZIP file is modified
+        self._cache_path = root.with_suffix(".val_instances.pkl")
+        self._cache_key = (_CACHE_VERSION, root.stat().st_mtime_ns, str(directory))
+
+        # pass images directory to super
         super().__init__(root, directory / "images", *args, **kwargs)
 
         if self.target_transform is not None:
@@ -120,7 +196,8 @@ class MegaDepthValidationDataset(ZippedImageFolder):
         # matches[scene] contains the class as integer, convert to list of str
         #   https://pandas.pydata.org/pandas-docs/stable/user_guide/text.html
         classes = matches["scene"].astype("string").tolist()
-        classes = list(set(classes))
+        # sort them, class indices have to be reproducible for the cached instances
+        classes = sorted(set(classes))
         for cls_name in classes:
             class_path = directory / cls_name
 
@@ -131,8 +208,57 @@ class MegaDepthValidationDataset(ZippedImageFolder):
         class_to_idx = {cls_name: i for i, cls_name in enumerate(classes)}
         return classes, class_to_idx
 
-    @staticmethod
     def make_dataset(
+        self,
+        zip_path: Tuple[ZipFile, Path],
+        class_to_idx: Dict[str, int],
+        extensions: Optional[Tuple[str, ...]] = None,
+        is_valid_file: Optional[Callable[[str], bool]] = None,
+    ) -> List[Tuple[str, int]]:
+        """
+        Generate a list of validation samples, reuse the cached result if possible.
+
+        Args:
+            zip_path (tuple of (ZipFile, Path)):
+                A opened zip file and root path in the file.
+            class_to_idx (Dict[str, int]): Dictionary mapping class name to class index.
+            extensions (Tuple[int, ...], optional): A list of allowed extensions.
+            is_valid_file (Callable[[str], bool], optional): A function that takes path
+                of a file and checks if it is a valid file.
+        """
+        try:
+            with open(self._cache_path, "rb") as fp:
+                cache = pickle.load(fp)
+            # anything unexpected in the cache, rebuild it
+            if (
+                cache["key"] == self._cache_key
+                and cache["class_to_idx"] == class_to_idx
+            ):
+                logger.debug(f"load validation instances from '{self._cache_path}'")
+                return cache["instances"]
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            logger.warning(f"unable to load cache '{self._cache_path}', {err}")
+
+        instances = self._make_dataset(
+            zip_path, class_to_idx, extensions, is_valid_file
+        )
+
+        cache = {
+            "key": self._cache_key,
+            "class_to_idx": class_to_idx,
+            "instances": instances,
+        }
+        save_atomic(
+            self._cache_path,
+            lambda fp: pickle.dump(cache, fp, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
+        return instances
+
+    @staticmethod
+    def _make_dataset(
         zip_path: Tuple[ZipFile, Path],
         class_to_idx: Dict[str, int],
         extensions: Optional[Tuple[str, ...]] = None,
@@ -163,26 +289,31 @@ class MegaDepthValidationDataset(ZippedImageFolder):
         path = directory.parent / "affine.pkl"
         stream = handle.open(str(path), "r")
         affine_mats = pickle.load(stream)
+        # (N, 2, 3), stack them into a single array, samples only hold views
+        affine_mats = np.stack(list(affine_mats.values())).astype(np.float32)
+
+        # load and compact feature coordinates
+        src_feats, src_lengths = _parse_coordinates(matches["XA"], matches["YA"])
+        tgt_feats, tgt_lengths = _parse_coordinates(matches["XB"], matches["YB"])
 
         instances = []
-        for (_, row), affine_mat in zip(matches.iterrows(), affine_mats.values()):
+        rows = zip(matches.itertuples(index=False), affine_mats)
+        for i, (row, affine_mat) in enumerate(rows):
             # class name
-            cls_name = row["scene"]
+            cls_name = row.scene
             class_index = class_to_idx[cls_name]
 
-            src_path, tgt_path = row["source_image"], row["target_image"]
-            src_path = directory / cls_name / src_path
-            src_path = handle.getinfo(str(src_path))
-            tgt_path = directory / cls_name / tgt_path
-            tgt_path = handle.getinfo(str(tgt_path))
+            # keep member names only, they are resolved with a dict lookup on access,
+            # and are much cheaper to pickle than ZipInfo
+            src_path = str(directory / cls_name / row.source_image)
+            tgt_path = str(directory / cls_name / row.target_image)
+            for path in (src_path, tgt_path):
+                # raise KeyError early if the member does not exist
+                handle.getinfo(path)
 
-            # load and compact feature coordinates
-            src_feat_x = np.fromstring(row["XA"], dtype=np.float32, sep=";")
-            src_feat_y = np.fromstring(row["YA"], dtype=np.float32, sep=";")
-            src_feat = np.stack([src_feat_x, src_feat_y], axis=-1)
-            tgt_feat_x = np.fromstring(row["XB"], dtype=np.float32, sep=";")
-            tgt_feat_y = np.fromstring(row["YB"], dtype=np.float32, sep=";")
-            tgt_feat = np.stack([tgt_feat_x, tgt_feat_y], axis=-1)
+            # drop the padding
+            src_feat = src_feats[i, : src_lengths[i]]
+            tgt_feat = tgt_feats[i, : tgt_lengths[i]]
 
             # NOTE
             # ground truth affine transformation matrix is stored directly
@@ -198,10 +329,8 @@ class MegaDepthValidationDataset(ZippedImageFolder):
         tgt_path, tgt_feat = target
 
         # load source and target images
-        stream = self._handle.open(src_path, "r")
-        src_image = self.loader(stream)
-        stream = self._handle.open(tgt_path, "r")
-        tgt_image = self.loader(stream)
+        src_image = self._load(src_path)
+        tgt_image = self._load(tgt_path)
 
         # image pair can have different size, but feature points must match
         # this project does not take occlusion in to consideration
@@ -227,6 +356,8 @@ class MegaDepthDataModule(pl.LightningDataModule):
         train_batch_size (int, optional): Samples per batch to load during training.
         val_image_size (int, optional): Minimum image size during validation.
         num_workers (int, optional): How many subprocesses to use for data loading.
+        cache_size (int, optional): Number of decoded images each dataset keeps in
+            memory, per worker. Workers are kept alive between epochs if this is set.
     """
 
     def __init__(
@@ -236,6 +367,7 @@ class MegaDepthDataModule(pl.LightningDataModule):
         train_batch_size: int = 16,
         val_image_size: Union[int, tuple] = 480,
         num_workers: int = 2,
+        cache_size: int = 0,
     ):
         super().__init__()
 
@@ -247,6 +379,7 @@ class MegaDepthDataModule(pl.LightningDataModule):
         self.val_image_size = val_image_size
 
         self.num_workers = num_workers
+        self.cache_size = cache_size
 
     def setup(self, stage: Optional[str] = None):
         train_transforms = Compose(
@@ -258,7 +391,10 @@ class MegaDepthDataModule(pl.LightningDataModule):
             ]
         )
         self.megadepth_train = MegaDepthTrainingDataset(
-            self.path, directory="train", transform=train_transforms
+            self.path,
+            directory="train",
+            transform=train_transforms,
+            cache_size=self.cache_size,
         )
 
         val_transforms = Compose(
@@ -271,12 +407,24 @@ class MegaDepthDataModule(pl.LightningDataModule):
             ]
         )
         self.megadepth_val = MegaDepthValidationDataset(
-            self.path, directory="validate", transform=val_transforms,
+            self.path,
+            directory="validate",
+            transform=val_transforms,
+            cache_size=self.cache_size,
         )
 
     def teardown(self, stage: Optional[str] = None):
-        # FIXME these datasets are zipped folder, close them for safety
-        pass
+        # these datasets are zipped folder, close them for safety
+        for name in ("megadepth_train", "megadepth_val"):
+            dataset = getattr(self, name, None)
+            if dataset is not None:
+                dataset.close()
+                delattr(self, name)
+
+    @property
+    def _persistent_workers(self) -> bool:
+        # decoded image cache lives in the workers, they have to survive across epochs
+        return self.cache_size > 0 and self.num_workers > 0
 
     def train_dataloader(self):
         megadepth_train = torch.utils.data.DataLoader(
@@ -285,6 +433,8 @@ class MegaDepthDataModule(pl.LightningDataModule):
             shuffle=True,
             drop_last=True,
             num_workers=self.num_workers,
+            persistent_workers=self._persistent_workers,
+            worker_init_fn=_seed_worker,
         )
         return megadepth_train
 
@@ -296,5 +446,6 @@ class MegaDepthDataModule(pl.LightningDataModule):
             batch_size=1,
             shuffle=False,
             num_workers=self.num_workers,
+            persistent_workers=self._persistent_workers,
         )
         return megadepth_val
@@ -145,8 +145,9 @@ class ResizeValidationImageFeatures(nn.Module):
 
         # 1) resize image pairs
         image = F.resize(image, size, self.interpolation)
-        # 2) resize feature points
-        features /= ratio
+        # 2) resize feature points, out-of-place, since features may share memory with
+        # the dataset
+        features = features / ratio
 
         return image, features
 
@@ -1,12 +1,32 @@
-import itertools
+import logging
+from pathlib import Path
 
 import antialiased_cnns
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..util import get_model_root, save_atomic
+
 __all__ = ["FeatureExtractor", "NeighborCorrelator"]
 
+logger = logging.getLogger("ransacflow.model.feature")
+
+
+def _build_resnet(pretrained: bool) -> nn.Sequential:
+    """Build ResNet-18 (antialiased) truncated after layer3."""
+    resnet = antialiased_cnns.resnet18(pretrained=pretrained)
+
+    # the original work replace the first conv layer with
+    #   - smaller kernel
+    #   - stride=1
+    #   - no bias
+    resnet.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False)
+
+    layer_list = ["conv1", "bn1", "relu", "maxpool", "layer1", "layer2", "layer3"]
+    layers = [getattr(resnet, name) for name in layer_list]
+    return nn.Sequential(*layers)
+
 
 class FeatureExtractor(nn.Module):
     """
@@ -19,20 +39,39 @@ class FeatureExtractor(nn.Module):
     def __init__(self, pretrained: bool = True):
         super().__init__()
 
-        resnet = antialiased_cnns.resnet18(pretrained=pretrained)
-
-        # the original work replace the first conv layer with
-        #   - smaller kernel
-        #   - stride=1
-        #   - no bias
-        resnet.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False)
-
-        layer_list = ["conv1", "bn1", "relu", "maxpool", "layer1", "layer2", "layer3"]
-        layers = [getattr(resnet, name) for name in layer_list]
-        resnet = nn.Sequential(*layers)
+        # pretrained weights we actually use are cached after the first download, so
+        # later instances can skip loading the full checkpoint
+        cache_path = get_model_root() / "resnet18_aa_layer3.pth"
+
+        resnet = None
+        if pretrained and cache_path.exists():
+            try:
+                resnet = _build_resnet(pretrained=False)
+                state_dict = torch.load(cache_path, map_location="cpu")
+                # conv1 is replaced, it never has pretrained weights
+                missing_keys, unexpected_keys = resnet.load_state_dict(
+                    state_dict, strict=False
+                )
+                if unexpected_keys or any(not k.startswith("0.") for k in missing_keys):
+                    raise RuntimeError("weights do not match the model")
+            except Exception as err:
+                logger.warning(f"unable to load cached weights '{cache_path}', {err}")
+                resnet = None
+
+        if resnet is None:
+            resnet = _build_resnet(pretrained=pretrained)
+            if pretrained:
+                self._save_cache(resnet, cache_path)
 
         self.resnet = resnet
 
+    @staticmethod
+    def _save_cache(resnet: nn.Sequential, cache_path: Path):
+        state_dict = {
+            k: v for k, v in resnet.state_dict().items() if not k.startswith("0.")
+        }
+        save_atomic(cache_path, lambda fp: torch.save(state_dict, fp))
+
     def forward(self, x):
         return self.resnet(x)
 
@@ -51,25 +90,20 @@ class NeighborCorrelator(nn.Module):
         assert kernel_size % 2 == 1, "kernel size has to be odd"
         self.kernel_size = kernel_size
 
-        self.zero_padding = nn.ZeroPad2d(kernel_size // 2)
-
     def forward(self, x, y):
         # normalize vectors first, so we don't have to divide them later
         x = F.normalize(x)
         y = F.normalize(y)
 
-        h, w = x.shape[-2:]
-        # move along the other image
-        y = self.zero_padding(y)
-
-        similarity = []
-        for i, j in itertools.product(range(self.kernel_size), range(self.kernel_size)):
-            similarity.append(
-                # (B, 1, W, H)
-                torch.sum(x * y[..., i : i + h, j : j + w], dim=1, keepdim=True)
-            )
+        n, c, h, w = x.shape
+        # move along the other image, gather all K*K shifted windows at once, zero
+        # padding is applied by unfold without an intermediate padded copy of y
+        #   (B, C*K*K, H*W)
+        k = self.kernel_size
+        y = F.unfold(y, kernel_size=k, padding=k // 2)
+        y = y.view(n, c, k * k, h, w)
 
-        # (B, K*K, W, H)
-        similarity = torch.cat(similarity, dim=1)
+        # (B, K*K, H, W)
+        similarity = torch.einsum("bchw,bckhw->bkhw", x, y)
 
         return similarity
@@ -87,24 +87,26 @@ class FlowPredictor(BaseFlowPredictor):
         self.softmax = nn.Softmax(dim=1)
 
         # generate the for local coordinate [-K//2, K//2]
-        ks = torch.arange(0, self.kernel_size) - self.kernel_size // 2
+        ks = torch.arange(0, self.kernel_size, dtype=torch.float32)
+        ks -= self.kernel_size // 2
         grid_x, grid_y = torch.meshgrid(ks, ks, indexing="xy")
 
-        # save these grid coordinates, and flatten it along the way
-        self.register_buffer("grid_x", grid_x.reshape(1, -1, 1, 1), persistent=False)
-        self.register_buffer("grid_y", grid_y.reshape(1, -1, 1, 1), persistent=False)
+        # save these grid coordinates as a (2, K*K) weight, flatten it along the way
+        grid_xy = torch.stack([grid_x.reshape(-1), grid_y.reshape(-1)], dim=0)
+        self.register_buffer("grid_xy", grid_xy, persistent=False)
 
     def forward(self, x):
         x = super().forward(x)
 
         x = self.conv4(x)
-        x = self.softmax(x)
 
-        # transform x from patches of local coordinate shifts, into global coordinate
-        flow_x = torch.sum(x * self.grid_x, dim=1, keepdim=True)
-        flow_y = torch.sum(x * self.grid_y, dim=1, keepdim=True)
-        # combine both flow to yield the final output
-        x = torch.cat([flow_x, flow_y], dim=1)
+        # flow is an expectation over the window, keep it in float32 under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = self.softmax(x.float())
+
+            # transform x from patches of local coordinate shifts, into global
+            # coordinate, both flow components are computed in a single pass
+            x = torch.einsum("bkhw,dk->bdhw", x, self.grid_xy.float())
 
         return x
 
@@ -3,6 +3,7 @@ from itertools import product
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 def conv3x3(in_features, out_features, stride=1):
@@ -32,27 +33,17 @@ class NetFlow(nn.Module):
         self.paddingSize = kernelSize // 2
 
         self.network = network  # network type: netFlowCoarse or netMatch
+        self.fused = False  # BatchNorm folded into conv, see eval_fuse()
 
         if self.network == "netFlowCoarse":
             self.conv4 = conv3x3(128, kernelSize * kernelSize)
-            self.gridY = (
-                torch.arange(-self.paddingSize, self.paddingSize + 1)
-                .view(1, 1, -1, 1)
-                .expand(1, 1, self.kernelSize, self.kernelSize)
-                .contiguous()
-                .view(1, -1, 1, 1)
-                .type(torch.FloatTensor)
+            g = torch.arange(
+                -self.paddingSize, self.paddingSize + 1, dtype=torch.float32
             )
-            self.gridX = (
-                torch.arange(-self.paddingSize, self.paddingSize + 1)
-                .view(1, 1, 1, -1)
-                .expand(1, 1, self.kernelSize, self.kernelSize)
-                .contiguous()
-                .view(1, -1, 1, 1)
-                .type(torch.FloatTensor)
-            )
-            # put gridX, gridY into gpu
-            self.gridX, self.gridY = self.gridX.cuda(), self.gridY.cuda()
+            gridY, gridX = torch.meshgrid(g, g, indexing="ij")
+            ## (2, K*K), both flow components are weighted sums of the same softmax
+            gridXY = torch.stack([gridX.reshape(-1), gridY.reshape(-1)], dim=0)
+            self.register_buffer("grid_xy", gridXY, persistent=False)
         elif self.network == "netMatch":
             self.conv4 = conv3x3(128, 1)
 
@@ -61,27 +52,38 @@ class NetFlow(nn.Module):
         elif self.network == "netMatch":
             self.sigmoid = torch.nn.Sigmoid()
 
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                if (
-                    m.in_channels != m.out_channels
-                    or m.out_channels != m.groups
-                    or m.bias is not None
-                ):
-                    # don't want to reinitialize downsample layers, code assuming normal conv layers will not have these characteristics
-                    nn.init.kaiming_normal_(
-                        m.weight, mode="fan_out", nonlinearity="relu"
-                    )
-                else:
-                    print("Not initializing")
-            elif isinstance(m, (nn.BatchNorm2d, nn.GroupNorm)):
-                nn.init.constant_(m.weight, 1)
-                nn.init.constant_(m.bias, 0)
+        ## initialize the known layers directly, instead of scanning self.modules()
+        for conv in (self.conv1, self.conv2, self.conv3, self.conv4):
+            nn.init.kaiming_normal_(conv.weight, mode="fan_out", nonlinearity="relu")
+        for bn in (self.bn1, self.bn2, self.bn3):
+            nn.init.constant_(bn.weight, 1)
+            nn.init.constant_(bn.bias, 0)
 
         ## make the initial matchability to 0.5
         if self.network == "netMatch":
             nn.init.normal_(self.conv4.weight, mean=0.0, std=0.0001)
 
+    def eval_fuse(self):
+        """
+        Fold bn1-bn3 into conv1-conv3 for inference, saves a pass over the feature maps
+        per BatchNorm. This cannot be undone, the module cannot be trained afterwards.
+        """
+        if self.training:
+            raise RuntimeError("BatchNorm can only be fused in evaluation mode")
+
+        for convName, bnName in (("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")):
+            conv = fuse_conv_bn_eval(getattr(self, convName), getattr(self, bnName))
+            setattr(self, convName, conv)
+            setattr(self, bnName, nn.Identity())
+        self.fused = True
+
+        return self
+
+    def train(self, mode=True):
+        if mode and self.fused:
+            raise RuntimeError("cannot train NetFlow after eval_fuse()")
+        return super(NetFlow, self).train(mode)
+
     def forward(self, x, up8X=True):
 
         ## x, y should be normalized
@@ -105,14 +107,15 @@ class NetFlow(nn.Module):
             x = self.softmax(x)
 
             ## flow. not sure why need to divide by h and w
-            flowX = torch.sum(x * self.gridX, dim=1, keepdim=True) / h * 2
-            flowY = torch.sum(x * self.gridY, dim=1, keepdim=True) / w * 2
-            flow = torch.cat((flowX, flowY), dim=1)
+            flow = torch.einsum("nkwh,dk->ndwh", x, self.grid_xy)
+            flow[:, 0] *= 2.0 / h
+            flow[:, 1] *= 2.0 / w
             x = flow
         elif self.network == "netMatch":
             x = self.sigmoid(x)
 
-        x = F.upsample_bilinear(x, size=None, scale_factor=8) if up8X else x
+        if up8X:
+            x = F.interpolate(x, scale_factor=8, mode="bilinear", align_corners=True)
         return x
 
 
@@ -124,11 +127,8 @@ def SSIM(I1Warp, I2, match, ssim):
 def predFlowCoarse(corrKernel, NetFlowCoarse, grid, up8X=True):
 
     flowCoarse = NetFlowCoarse(corrKernel, up8X)  ## output is with dimension B, 2, W, H
-    _, _, w, h = flowCoarse.size()
-    flowGrad = flowCoarse.narrow(2, 1, w - 1).narrow(3, 1, h - 1) - flowCoarse.narrow(
-        2, 0, w - 1
-    ).narrow(3, 0, h - 1)
-    flowGrad = torch.norm(flowGrad, dim=1, keepdim=True)
+    flowGrad = flowCoarse[..., 1:, 1:] - flowCoarse[..., :-1, :-1]
+    flowGrad = torch.linalg.vector_norm(flowGrad, dim=1, keepdim=True)
     flowCoarse = flowCoarse.permute(0, 2, 3, 1)
     flowCoarse = torch.clamp(flowCoarse + grid, min=-1, max=1)
 
@@ -1,3 +1,4 @@
+import contextlib
 import itertools
 import logging
 from typing import List, Optional
@@ -36,6 +37,9 @@ class RANSACFlowModel(pl.LightningModule):
         kernel_size (int): FIXME TBD, we assume it is square
         lr (float): Learning rate.
         pretrained (bool, optional): Use pretrained model.
+        mixed_precision (bool, optional): Run the networks in bfloat16 with channels
+            last memory format, flow is still estimated in float32.
+        compile_networks (bool, optional): Compile the networks with `torch.compile`.
     """
 
     def __init__(
@@ -47,6 +51,8 @@ class RANSACFlowModel(pl.LightningModule):
         ssim_window_size: int,
         lr: float,
         pretrained: bool = True,
+        mixed_precision: bool = False,
+        compile_networks: bool = False,
     ):
         super().__init__()
 
@@ -60,6 +66,23 @@ class RANSACFlowModel(pl.LightningModule):
         self.flow = FlowPredictor(kernel_size)
         self.matchability = MatchabilityPredictor(kernel_size)
 
+        if mixed_precision:
+            # convolutions in bfloat16 are faster in NHWC on tensor cores
+            self.feature_extractor.to(memory_format=torch.channels_last)
+            self.flow.to(memory_format=torch.channels_last)
+            self.matchability.to(memory_format=torch.channels_last)
+
+        if compile_networks:
+            # compile in-place, wrapping the modules with torch.compile() will prefix
+            # their state_dict keys
+            for network in (
+                self.feature_extractor,
+                self.correlator,
+                self.flow,
+                self.matchability,
+            ):
+                network.compile()
+
         # FIXME how to load weights (in later stages?)
 
         # FIXME set non-trainalbe network to eval()
@@ -108,15 +131,28 @@ class RANSACFlowModel(pl.LightningModule):
             # NOTE F.grid_sample() expects grid dimension (B, H, W, 2)
             self.grid = torch.stack([grid_x, grid_y], dim=-1).unsqueeze(0)
 
-        # extract feature correlation map
-        f_s = self.feature_extractor(I_s)
-        f_t = self.feature_extractor(I_t)
+        # NOTE don't enter a disabled autocast, it overrides the one from Trainer
+        if self.hparams.mixed_precision:
+            amp_context = torch.autocast(
+                device_type=I_s.device.type, dtype=torch.bfloat16
+            )
+        else:
+            amp_context = contextlib.nullcontext()
+
+        with amp_context:
+            if self.hparams.mixed_precision:
+                I_s = I_s.contiguous(memory_format=torch.channels_last)
+                I_t = I_t.contiguous(memory_format=torch.channels_last)
+
+            # extract feature correlation map
+            f_s = self.feature_extractor(I_s)
+            f_t = self.feature_extractor(I_t)
 
-        # calculate cosine similarity
-        s_st = self.correlator(f_s, f_t)
+            # calculate cosine similarity
+            s_st = self.correlator(f_s, f_t)
 
-        # estimate flow
-        F_st = self.flow(s_st)
+            # estimate flow
+            F_st = self.flow(s_st)
         F_st = F.interpolate(F_st, size=tuple(self.image_size), mode="bilinear")
         F_st /= self.scale
 
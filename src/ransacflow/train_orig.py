@@ -33,11 +33,8 @@ if not sys.warnoptions:
 def predFlowCoarse(corrKernel, NetFlowCoarse, grid, up8X=True):
 
     flowCoarse = NetFlowCoarse(corrKernel, up8X)  ## output is with dimension B, 2, W, H
-    _, _, w, h = flowCoarse.size()
-    flowGrad = flowCoarse.narrow(2, 1, w - 1).narrow(3, 1, h - 1) - flowCoarse.narrow(
-        2, 0, w - 1
-    ).narrow(3, 0, h - 1)
-    flowGrad = torch.norm(flowGrad, dim=1, keepdim=True)
+    flowGrad = flowCoarse[..., 1:, 1:] - flowCoarse[..., :-1, :-1]
+    flowGrad = torch.linalg.vector_norm(flowGrad, dim=1, keepdim=True)
     flowCoarse = flowCoarse.permute(0, 2, 3, 1)
     flowCoarse = torch.clamp(flowCoarse + grid, min=-1, max=1)
 
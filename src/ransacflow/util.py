@@ -1,4 +1,9 @@
+import logging
+import os
 from pathlib import Path
+from typing import BinaryIO, Callable
+
+logger = logging.getLogger("ransacflow.util")
 
 
 def get_project_root() -> Path:
@@ -13,3 +18,35 @@ def get_model_root() -> Path:
 def get_data_root() -> Path:
     return get_project_root() / "data"
 
+
+
+def save_atomic(path: Path, save: Callable[[BinaryIO], None]) -> bool:
+    """
+    Write a file through a temporary file, so processes writing the same path at once
+    never leave a partially written file behind.
+
+    Args:
+        path (Path): Destination of the file.
+        save (Callable[[BinaryIO], None]): A function that writes the content to a
+            binary file object.
+
+    Returns:
+        (bool): True if the file is written, failures other than OSError are raised.
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as fp:
+            save(fp)
+        os.replace(tmp_path, path)
+    except BaseException as err:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+
+        if not isinstance(err, OSError):
+            raise
+        logger.warning(f"unable to save '{path}', {err}")
+        return False
+
+    return True
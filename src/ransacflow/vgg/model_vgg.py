@@ -237,11 +237,11 @@ class NetFlow(nn.Module):
             flowX = torch.sum(x * self.gridX, dim=1, keepdim=True) / h * 2
             flowY = torch.sum(x * self.gridY, dim=1, keepdim=True) / w * 2
             flow = torch.cat((flowX, flowY), dim=1)
-            flow = F.upsample_bilinear(flow, size=None, scale_factor=8) if up8X else flow
+            flow = F.interpolate(flow, scale_factor=8, mode="bilinear", align_corners=True) if up8X else flow
         
             return flow
         
-        x = F.upsample_bilinear(x, size=None, scale_factor=8) if up8X else x
+        x = F.interpolate(x, scale_factor=8, mode="bilinear", align_corners=True) if up8X else x
         return x
         
         